@@ -11,65 +11,252 @@ AUTHOR: Daisuke Arai
 
 import os
 import sys
-import argparse
-import random
 import hashlib
+import json
+import shlex
+import secrets
 import time
+import importlib.util
+from importlib import metadata
 from shutil import which
 from contextlib import suppress
 from pathlib import Path
 from shutil import rmtree
+from types import SimpleNamespace
 
 
+HOME = Path.home()
 KEY_JUPYTER_DATA_DIR = 'JUPYTER_DATA_DIR'
+KEY_NB_PROJECT_ROOT = 'NB_PROJECT_ROOT'
+FINGERPRINT_FILE = '.nb-fingerprint'
+# Interpreter options inserted in the kernel argv. Interpreters before 3.11
+# ignore unknown -X options.
+DEFAULT_KERNEL_ARGS = ('-Xfrozen_modules=on',)
+RM_THRESHOLD = 64  # entries in a kernel dir before removing it with rm
+MODE_UPDATE_ONLY = 'update_only'
+MODE_NOTEBOOK = 'notebook'
+MODE_LAB = 'lab'
+DEFAULT_IP = '127.0.0.1'
+OPT_IP = '--NotebookApp.ip'
+OPT_PASSWORD = '--NotebookApp.password'
+OPT_DEFAULT_KERNEL_NAME = '--MultiKernelManager.default_kernel_name'
+NO_PASSWORD_ARGS = ('--NotebookApp.token', '', '--NotebookApp.password_required', 'False')
+ROOT_CACHE_SIZE = 256  # cwd entries kept in the root cache
+ROOT_CACHE_FILE = Path(os.environ.get('XDG_CACHE_HOME') or HOME / '.cache') / 'nb' / 'root-cache.json'
 
 def print_error(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-def is_project_root_dir(x):
-    return x.parent if x.is_dir() else None
+def make_password(plain_password):
+    salt = secrets.token_hex(6)  # 12 hex chars, notebook.auth.salt_len
+    digest = hashlib.sha1(f'{plain_password}{salt}'.encode('utf-8')).hexdigest()
+    return f'sha1:{salt}:{digest}'
 
-def is_project_root_file(x):
-    return x.parent if x.is_file() else None
+def kernel_fingerprint(python_executable, kernel_name, kernel_args):
+    try:
+        ipykernel_version = metadata.version('ipykernel')
+    except metadata.PackageNotFoundError:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    for part in (python_executable, kernel_name, ipykernel_version, *kernel_args):
+        h.update(part.encode('utf-8') + b'\0')
+    return h.hexdigest()
 
-ROOT_SPECS = {
-    '.git': is_project_root_dir,
-    'pyproject.toml': is_project_root_file,
-}
+def is_kernel_spec_current(kernel_path, python_executable, kernel_name, kernel_args):
+    try:
+        with open(kernel_path / 'kernel.json') as f:
+            spec = json.load(f)
+    except (OSError, ValueError):
+        return False
+    argv = spec.get('argv') if isinstance(spec, dict) else None
+    return (bool(argv) and argv[0] == python_executable
+            and argv[1:2 + len(kernel_args)] == [*kernel_args, '-m']
+            and spec.get('display_name') == kernel_name)
 
-def make_password(plain_password):
-    salt_len = 12  # notebook.auth.salt_len
-    h = hashlib.new('sha1')
-    salt = f"{random.getrandbits(4 * salt_len):0{salt_len}x}"
-    h.update(plain_password.encode('utf-8') + salt.encode('ascii'))
-    password = ':'.join(('sha1', salt, h.hexdigest()))
-    return password
-
-def find_project_root_recurse(d, find_root):
-    rel = d.relative_to(find_root)  # raise ValueError if d outside find_root
-    if str(rel) == '.':
-        return None
-    for item in d.iterdir():
-        spec = ROOT_SPECS.get(item.name)
-        if spec:
-            found = spec(item)
-            if found:
-                return found
+def is_kernel_up_to_date(kernel_path, python_executable, kernel_name, kernel_args, fingerprint):
+    if fingerprint is None or not (kernel_path / 'kernel.json').is_file():
+        return False
+    try:
+        return (kernel_path / FINGERPRINT_FILE).read_text() == fingerprint
+    except FileNotFoundError:
+        pass  # fingerprint lost, check the spec itself
+    except OSError:
+        return False
+    if not is_kernel_spec_current(kernel_path, python_executable, kernel_name, kernel_args):
+        return False
+    with suppress(OSError):
+        write_fingerprint(kernel_path, fingerprint)
+    return True
+
+def insert_kernel_args(kernel_path, kernel_args):
+    if not kernel_args:
+        return
+    spec_file = kernel_path / 'kernel.json'
+    with open(spec_file) as f:
+        spec = json.load(f)
+    spec['argv'][1:1] = kernel_args
+    tmp = spec_file.with_name(f'kernel.json.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(spec, f, indent=1)
+    os.replace(tmp, spec_file)
+
+def write_fingerprint(kernel_path, fingerprint):
+    if fingerprint is None:
+        return
+    target = kernel_path / FINGERPRINT_FILE
+    tmp = target.with_name(f'{FINGERPRINT_FILE}.{os.getpid()}.tmp')
+    tmp.write_text(fingerprint)
+    os.replace(tmp, target)
+
+def is_large_tree(path):
+    # A spec written by write_kernel_spec is a handful of flat files; treat
+    # anything with subdirectories or many entries as a large leftover tree.
+    try:
+        with os.scandir(path) as it:
+            for i, entry in enumerate(it):
+                if i >= RM_THRESHOLD or entry.is_dir(follow_symlinks=False):
+                    return True
+    except FileNotFoundError:
+        pass
+    return False
+
+def fast_rmtree(path):
+    # native rm is much faster than shutil.rmtree on large trees, but
+    # spawning it costs more than removing a small kernel spec directly
+    if is_large_tree(path):
+        import subprocess
+        rm = which('rm')
+        if rm and subprocess.run([rm, '-rf', '--', str(path)]).returncode == 0:
+            return
+    # also reports the real error if rm failed
+    with suppress(FileNotFoundError):
+        rmtree(path)
+
+def reinstall_kernel(kernel_path, kernel_name, python_executable, kernel_args, fingerprint):
+    # ipykernel pulls in traitlets and jupyter_core, import it only when needed
+    try:
+        import ipykernel.kernelspec
+    except ImportError:
+        print_error('\n\n***WARNING***\n\tipykernel is not installed. please run pip install ipykernel\n\n')
+        time.sleep(2)
+        return
+    fast_rmtree(kernel_path)
+    kernel_path.parent.mkdir(parents=True, exist_ok=True)
+    overrides = {
+        "display_name": kernel_name,
+    }
+    old_executable = sys.executable
     try:
-        return find_project_root_recurse(d.parent, find_root)
-    except ValueError:
+        sys.executable = python_executable
+        ipykernel.kernelspec.write_kernel_spec(path=str(kernel_path), overrides=overrides)
+    finally:
+        sys.executable = old_executable
+    insert_kernel_args(kernel_path, kernel_args)
+    write_fingerprint(kernel_path, fingerprint)
+
+def is_relative_to(path, other):
+    # PurePath.is_relative_to() needs Python 3.9
+    return path == other or other in path.parents
+
+def walk_project_root(d, find_root):
+    # Walk up from d, stopping before find_root. DirEntry type checks use the
+    # file type reported by readdir, so non-matching entries cost no stat.
+    if not is_relative_to(d, find_root):
         return None
+    while d != find_root:
+        with os.scandir(d) as it:
+            for entry in it:
+                name = entry.name
+                if name == '.git' or name == 'pyproject.toml':
+                    found = entry.is_dir() if name == '.git' else entry.is_file()
+                    if found:
+                        return d
+        d = d.parent
+    return None
 
 def find_project_root(directory='.'):
     d = Path(directory).resolve()
-    root = Path('~').expanduser()
+    root = HOME if is_relative_to(d, HOME) else Path('/')
+    return walk_project_root(d, root)
+
+def is_project_root(d):
+    return (d / '.git').is_dir() or (d / 'pyproject.toml').is_file()
+
+def load_root_cache():
     try:
-        d.relative_to(root)
-    except ValueError:
-        root = Path('/')
-    return find_project_root_recurse(Path(directory).resolve(), root)
+        with open(ROOT_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
 
-def main():
+def save_root_cache(cache):
+    # drop entries for directories that are gone and keep the newest ones
+    cache = {cwd: root for cwd, root in cache.items() if os.path.isdir(cwd)}
+    cache = dict(list(cache.items())[-ROOT_CACHE_SIZE:])
+    tmp = ROOT_CACHE_FILE.with_name(f'{ROOT_CACHE_FILE.name}.{os.getpid()}.tmp')
+    with suppress(OSError):
+        ROOT_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, ROOT_CACHE_FILE)
+
+def is_root_cache_valid(cwd, cached):
+    # Check the markers directly rather than directory mtimes, which change
+    # whenever a notebook in cwd is saved. A marker added between cwd and
+    # the cached root makes the entry stale.
+    if not isinstance(cached, str):
+        return False
+    root = Path(cached)
+    if not is_relative_to(cwd, root) or not is_project_root(root):
+        return False
+    d = cwd
+    while d != root:
+        if is_project_root(d):
+            return False
+        d = d.parent
+    return True
+
+def find_project_root_cached():
+    env_root = os.environ.get(KEY_NB_PROJECT_ROOT, '')
+    if env_root != '':
+        root = Path(env_root).expanduser().resolve()
+        if root.name != '':
+            return root
+        # a filesystem root has no name to use as the kernel directory
+        print_error(f'Ignoring {KEY_NB_PROJECT_ROOT}={env_root}: not usable as a project root')
+        return None
+    cwd = Path.cwd().resolve()
+    cache = load_root_cache()
+    cached = cache.get(str(cwd))
+    if is_root_cache_valid(cwd, cached):
+        return Path(cached)
+    root = find_project_root(cwd)
+    if root is not None:
+        cache.pop(str(cwd), None)  # re-insert as the newest entry
+        cache[str(cwd)] = str(root)
+        save_root_cache(cache)
+    return root
+
+FLAG_OPTIONS = {
+    '--nb-verbose': 'nb_verbose',
+    '--only-update-kernel': 'only_update_kernel',
+    '-N': 'no_password',
+    '--no-password': 'no_password',
+    '--notebook': 'notebook',
+    '--nb-python': 'nb_python',
+}
+
+VALUE_OPTIONS = {
+    '--ip': 'ip',
+    '--python': 'python',
+    '--kernel-args': 'kernel_args',
+    '-p': 'password',
+    '--password': 'password',
+}
+
+def build_parser():
+    import argparse
 
     parser = argparse.ArgumentParser(
         prog='Jupyter Notebook Wrapper',
@@ -81,91 +268,137 @@ def main():
     parser.add_argument('-N', '--no-password', action='store_true')
     parser.add_argument('--notebook', action='store_true')
     parser.add_argument('--python')
+    parser.add_argument('--kernel-args',
+                        help='interpreter options for the kernel, e.g. --kernel-args="-X importtime"')
+    parser.add_argument('--nb-python', action='store_true',
+                        help="use nb's own python for the kernel instead of python3 on PATH")
     parser.add_argument('-p', '--password')
-    args, rest_of_args = parser.parse_known_args()
+    return parser
+
+def needs_argparse(arg):
+    # Tokens whose meaning depends on argparse rules: help, abbreviations of
+    # our long options, attached short option values and '--'.
+    if arg in ('-h', '--help', '--'):
+        return True
+    if arg.startswith('--'):
+        name = arg.split('=', 1)[0]
+        return any(o.startswith(name) for o in (*FLAG_OPTIONS, *VALUE_OPTIONS) if o.startswith('--'))
+    return arg[:2] in FLAG_OPTIONS or arg[:2] in VALUE_OPTIONS
+
+def parse_args(argv):
+    """Fast equivalent of build_parser().parse_known_args(argv).
+
+    Falls back to argparse for anything but exact option matches.
+    """
+    args = SimpleNamespace(**{dest: False for dest in FLAG_OPTIONS.values()},
+                           **{dest: None for dest in VALUE_OPTIONS.values()})
+    rest_of_args = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        name, sep, value = arg.partition('=')
+        if arg in FLAG_OPTIONS:
+            setattr(args, FLAG_OPTIONS[arg], True)
+        elif arg in VALUE_OPTIONS:
+            i += 1
+            if i == len(argv) or argv[i].startswith('-'):
+                return build_parser().parse_known_args(argv)
+            setattr(args, VALUE_OPTIONS[arg], argv[i])
+        elif sep and name.startswith('--') and name in VALUE_OPTIONS:
+            setattr(args, VALUE_OPTIONS[name], value)
+        elif arg.startswith('-') and needs_argparse(arg):
+            return build_parser().parse_known_args(argv)
+        else:
+            rest_of_args.append(arg)
+        i += 1
+    return args, rest_of_args
+
+def make_plan(args, kernel_name):
+    if args.only_update_kernel:
+        return SimpleNamespace(mode=MODE_UPDATE_ONLY, extra_argv=[])
+
+    # check jupyterlab is installed without importing it
+    if args.notebook or importlib.util.find_spec('jupyterlab') is None:
+        mode = MODE_NOTEBOOK
+    else:
+        mode = MODE_LAB
+
+    password = args.password
+    if mode == MODE_LAB and args.no_password:
+        # password_required=False does not work for Jupyter lab.
+        password = ""  # Use an encrypted blank password instead.
+
+    # change default listen address to 127.0.0.1 for avoid HSTS
+    extra = [ OPT_IP, args.ip if args.ip is not None else DEFAULT_IP ]
+    extra += [ OPT_PASSWORD, "" if password is None else make_password(password) ]
+    if args.no_password:
+        extra += NO_PASSWORD_ARGS
+    if mode == MODE_LAB:
+        extra += [ OPT_DEFAULT_KERNEL_NAME, kernel_name ]
+    return SimpleNamespace(mode=mode, extra_argv=extra)
+
+def dispatch(plan):
+    if plan.mode == MODE_UPDATE_ONLY:
+        return
+
+    sys.argv.extend(plan.extra_argv)
+
+    # Replace this process with the server instead of running it in-process,
+    # so none of nb's own state stays resident for the whole session.
+    if plan.mode == MODE_NOTEBOOK:
+        if importlib.util.find_spec('notebook') is None:
+            print_error('Please install notebook or jupyterlab')
+            sys.exit(1)
+        module = 'notebook'
+    else:
+        module = 'jupyterlab'
+    # execv does not flush Python's stdio buffers
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, '-m', module] + sys.argv[1:])
+
+def main():
+
+    args, rest_of_args = parse_args(sys.argv[1:])
     sys.argv = [ sys.executable ] + rest_of_args
-    
-    python_executable = args.python or which('python3') or sys.executable
+
+    if args.nb_python:
+        python_executable = args.python or sys.executable
+    else:
+        python_executable = args.python or which('python3') or sys.executable
 
     # get jupyter data directory
     jupyter_data_dir = os.environ.get(KEY_JUPYTER_DATA_DIR, '')
     if jupyter_data_dir == '':
-        jupyter_data_dir = Path('~/.local/share/jupyter').expanduser()
+        jupyter_data_dir = HOME / '.local' / 'share' / 'jupyter'
+    else:
+        jupyter_data_dir = Path(jupyter_data_dir).absolute()
 
     # find project root
-    root = find_project_root()
+    root = find_project_root_cached()
 
     # Kernel spec directory
-    kernel_name = 'default' if root is None else root.name
-    kernel_path = Path(jupyter_data_dir) / 'kernels' / kernel_name
-    os.environ[KEY_JUPYTER_DATA_DIR] = str(Path(jupyter_data_dir).absolute())
+    kernel_name = 'default' if root is None or root.name == '' else root.name
+    kernel_path = jupyter_data_dir / 'kernels' / kernel_name
+    if os.environ.get(KEY_JUPYTER_DATA_DIR) != str(jupyter_data_dir):
+        os.environ[KEY_JUPYTER_DATA_DIR] = str(jupyter_data_dir)
 
     if args.nb_verbose:
         print_error(f'Target python executable is {python_executable}')
         print_error(f'Target kernel path is {kernel_path}')
 
-    # Re-install kernel
-    try:
-        import ipykernel.kernelspec
-    except ImportError:
-        print_error('\n\n***WARNING***\n\tipykernel is not installed. please run pip install ipykernel\n\n')
-        time.sleep(2)
-    else:
-        with suppress(FileNotFoundError):
-            rmtree(kernel_path)
-        kernel_path.parent.mkdir(parents=True, exist_ok=True)
-        overrides = {
-            "display_name": kernel_name,
-        }
-        old_executable = sys.executable
-        try:
-            sys.executable = python_executable
-            ipykernel.kernelspec.write_kernel_spec(path=str(kernel_path), overrides=overrides)
-        finally:
-            sys.executable = old_executable
-
-    if args.ip is not None:
-        sys.argv += [ '--NotebookApp.ip', args.ip ]
-    else:
-        # change default listen address to 127.0.0.1 for avoid HSTS
-        sys.argv += [ '--NotebookApp.ip', '127.0.0.1' ]
-
-    # check jupyterlab is installed
-    if not args.notebook:
-        try:
-            from jupyterlab.labapp import main as labapp_main
-        except ImportError:
-            args.notebook = True
-            pass
-
-    if args.only_update_kernel:
-        return
-
-    if not args.notebook and args.no_password:
-        # password_required=False does not work for Jupyter lab.
-        args.password = ""  # Use an encrypted blank password instead.
-
-    if args.password is not None:
-        sys.argv += [ "--NotebookApp.password", make_password(args.password) ]
+    # Re-install kernel unless the installed spec is up to date
+    if args.kernel_args is None:
+        kernel_args = list(DEFAULT_KERNEL_ARGS)
     else:
-        sys.argv += [ "--NotebookApp.password", "" ]
-
-    if args.no_password:
-        sys.argv += [ "--NotebookApp.token", "" ]
-        sys.argv += [ "--NotebookApp.password_required", "False" ]
+        kernel_args = shlex.split(args.kernel_args)
+    fingerprint = kernel_fingerprint(python_executable, kernel_name, kernel_args)
+    if args.only_update_kernel or not is_kernel_up_to_date(kernel_path, python_executable, kernel_name, kernel_args, fingerprint):
+        reinstall_kernel(kernel_path, kernel_name, python_executable, kernel_args, fingerprint)
+    elif args.nb_verbose:
+        print_error('Kernel spec is up to date')
 
-    if args.notebook:
-        try:
-            from jupyter_core.command import main
-        except ImportError:
-            print_error('Please install notebook or jupyterlab')
-            sys.exit(1)
-        else:
-            sys.argv = [sys.executable, 'notebook'] + sys.argv[1:]
-            main()
-    else:
-        sys.argv += [ '--MultiKernelManager.default_kernel_name', kernel_name ]
-        labapp_main(argv=sys.argv[1:])
+    dispatch(make_plan(args, kernel_name))
 
 
 if __name__ == '__main__':